@@ -4,11 +4,21 @@
 
 import os
 import re
+import copy
+import errno
+import shutil
+import tempfile
 import yaml
 from datetime import datetime
 import subprocess
 from flask import Blueprint, jsonify, request, send_file
 
+# استفاده از Loader/Dumper مبتنی بر libyaml (C) در صورت وجود
+try:
+    from yaml import CSafeLoader as SafeLoader, CSafeDumper as SafeDumper
+except ImportError:
+    from yaml import SafeLoader, SafeDumper
+
 # ایجاد Blueprint برای Ansible
 ansible_bp = Blueprint('ansible', __name__, url_prefix='/api')
 
@@ -17,21 +27,98 @@ BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
 INVENTORY_FILE = os.path.join(BASE_DIR, "inventory.yml")
 PLAYBOOK_FILE = os.path.join(BASE_DIR, "playbook.yml")
 
-def load_inventory():
-    """بارگذاری فایل inventory"""
+# کش inventory پارس‌شده به صورت یک snapshot: (key, data, customer_vars)
+# key همان (mtime, size) فایل است و customer_vars متغیرهای ادغام‌شده هر مشتری برای همین data؛
+# snapshot همیشه با یک انتساب جایگزین می‌شود تا درخواست‌های هم‌زمان نسخه‌های ناهمخوان نبینند
+_inventory_snapshot = (None, None, {})
+
+def _load_inventory_snapshot():
+    """دریافت snapshot فعلی inventory؛ در صورت تغییر فایل دوباره پارس می‌شود"""
+    global _inventory_snapshot
     try:
-        with open(INVENTORY_FILE, "r") as f:
-            return yaml.safe_load(f)
+        stats = os.stat(INVENTORY_FILE)
+        key = (stats.st_mtime_ns, stats.st_size)
+        
+        snapshot = _inventory_snapshot
+        if snapshot[0] != key:
+            with open(INVENTORY_FILE, "rb") as f:
+                data = yaml.load(f.read(), Loader=SafeLoader)
+            snapshot = (key, data, {})
+            _inventory_snapshot = snapshot
+        
+        return snapshot
     except FileNotFoundError:
-        return {"all": {"hosts": {}, "vars": {}}}
+        return (None, {"all": {"hosts": {}, "vars": {}}}, {})
     except Exception as e:
         raise Exception(f"خطا در خواندن فایل inventory: {str(e)}")
 
+def load_inventory(mutable=False):
+    """بارگذاری فایل inventory
+    
+    به صورت پیش‌فرض نسخه مشترک کش برگردانده می‌شود و نباید تغییر داده شود؛
+    برای ویرایش، mutable=True یک کپی مستقل برمی‌گرداند.
+    """
+    data = _load_inventory_snapshot()[1]
+    
+    if mutable:
+        return copy.deepcopy(data)
+    return data
+
+def _write_inventory_in_place(path, content):
+    """نوشتن مستقیم روی فایل inventory (روش غیراتمیک قبلی)"""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(content)
+
+def _replace_inventory_atomic(path, content):
+    """نوشتن در فایل موقت کنار inventory و جایگزینی اتمیک با os.replace"""
+    fd, temp_file = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".inventory.", suffix=".tmp")
+    try:
+        try:
+            f = os.fdopen(fd, "w", encoding="utf-8")
+        except Exception:
+            os.close(fd)
+            raise
+        
+        with f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        
+        # حفظ مالک و سطح دسترسی فایل فعلی (mkstemp فایل را با 0600 و مالک پروسه می‌سازد)
+        try:
+            stats = os.stat(path)
+        except FileNotFoundError:
+            os.chmod(temp_file, 0o644)
+        else:
+            try:
+                os.chown(temp_file, stats.st_uid, stats.st_gid)
+            except PermissionError:
+                pass
+            os.chmod(temp_file, stats.st_mode & 0o7777)
+        
+        os.replace(temp_file, path)
+    except Exception:
+        os.unlink(temp_file)
+        raise
+
 def save_inventory(data):
     """ذخیره فایل inventory"""
+    global _inventory_snapshot
     try:
-        with open(INVENTORY_FILE, "w") as f:
-            yaml.dump(data, f, allow_unicode=True, default_flow_style=False)
+        content = yaml.dump(data, Dumper=SafeDumper, allow_unicode=True, default_flow_style=False)
+        
+        # اگر inventory یک symlink باشد، فایل مقصد آن جایگزین می‌شود نه خود لینک
+        target = os.path.realpath(INVENTORY_FILE)
+        
+        _inventory_snapshot = (None, None, {})
+        
+        try:
+            _replace_inventory_atomic(target, content)
+        except OSError as e:
+            # پوشه قابل نوشتن نیست یا فایل به صورت bind mount است: نوشتن مستقیم مانند قبل
+            if not isinstance(e, PermissionError) and e.errno != errno.EBUSY:
+                raise
+            _write_inventory_in_place(target, content)
         return True
     except Exception as e:
         raise Exception(f"خطا در ذخیره فایل inventory: {str(e)}")
@@ -74,7 +161,7 @@ def api_inventory_save():
             }), 400
         
         # بارگذاری inventory فعلی
-        inventory = load_inventory()
+        inventory = load_inventory(mutable=True)
         
         # اطمینان از ساختار inventory
         if "all" not in inventory:
@@ -147,15 +234,10 @@ def api_inventory_customer(customer_name):
         
         customer_data = inventory["all"]["hosts"][customer_name]
         
-        # ادغام متغیرهای global با متغیرهای مشتری
-        global_vars = inventory.get("all", {}).get("vars", {})
-        customer_vars = customer_data.get("vars", {})
-        merged_vars = {**global_vars, **customer_vars}
-        
         return jsonify({
             "status": "success",
             "customer": customer_name,
-            "vars": merged_vars,
+            "vars": get_customer_vars(customer_name),
             "raw_data": customer_data
         })
         
@@ -294,16 +376,22 @@ def validate_inventory_structure(inventory):
     return True, "ساختار معتبر است"
 
 def get_customer_vars(customer_name):
-    """دریافت متغیرهای یک مشتری با ادغام global vars"""
-    inventory = load_inventory()
+    """دریافت متغیرهای یک مشتری با ادغام global vars
+    
+    نتیجه تا تغییر بعدی inventory کش می‌شود و نباید تغییر داده شود.
+    """
+    # inventory و کش متغیرها از یک snapshot خوانده می‌شوند تا ادغام با نسخه قدیمی در کش جدید ننشیند
+    _, inventory, resolved = _load_inventory_snapshot()
     
     if customer_name not in inventory.get("all", {}).get("hosts", {}):
         return {}
     
-    global_vars = inventory.get("all", {}).get("vars", {})
-    customer_vars = inventory["all"]["hosts"][customer_name].get("vars", {})
+    if customer_name not in resolved:
+        global_vars = inventory.get("all", {}).get("vars", {})
+        customer_vars = inventory["all"]["hosts"][customer_name].get("vars", {})
+        resolved[customer_name] = {**global_vars, **customer_vars}
     
-    return {**global_vars, **customer_vars}
+    return resolved[customer_name]
 
 def get_available_modules():
     """دریافت لیست ماژول‌های موجود"""
@@ -343,67 +431,69 @@ def api_backup_list():
         for customer in customers:
             customer_backup_dir = os.path.join(backup_path, customer)
             
-            if os.path.exists(customer_backup_dir) and os.path.isdir(customer_backup_dir):
+            if os.path.isdir(customer_backup_dir):
                 customer_backups = []
                 
-                # لیست پوشه‌های بک‌اپ
-                for item in os.listdir(customer_backup_dir):
-                    item_path = os.path.join(customer_backup_dir, item)
-                    
-                    if os.path.isdir(item_path) and item.startswith("202"):
-                        try:
-                            # پارس کردن تاریخ از نام پوشه
-                            date_parts = item.split('-')
-                            if len(date_parts) >= 3:
-                                date_str = f"{date_parts[0]}-{date_parts[1]}-{date_parts[2]}"
-                                time_str = f"{date_parts[3]}:{date_parts[4]}:{date_parts[5]}" if len(date_parts) >= 6 else "00:00:00"
-                                
-                                # محاسبه سایز پوشه
-                                total_size = 0
-                                file_count = 0
-                                backup_files = []
-                                
-                                for root, dirs, files in os.walk(item_path):
-                                    for file in files:
-                                        if not (file.endswith('.sh') or 'backup_' in file):
-                                            file_path = os.path.join(root, file)
-                                            file_size = os.path.getsize(file_path)
-                                            total_size += file_size
-                                            file_count += 1
-                                            
-                                            # جزئیات فایل
-                                            rel_path = os.path.relpath(file_path, item_path)
-                                            backup_files.append({
-                                                "name": file,
-                                                "path": rel_path,
-                                                "size": file_size,
-                                                "size_formatted": f"{file_size / 1024:.2f} KB" if file_size < 1024*1024 else f"{file_size / (1024*1024):.2f} MB"
-                                            })
-                                
-                                # مرتب کردن فایل‌ها بر اساس نوع
-                                database_files = [f for f in backup_files if f["name"].endswith('.sql.gz')]
-                                volume_files = [f for f in backup_files if f["name"].endswith('.tar.gz')]
-                                other_files = [f for f in backup_files if f not in database_files + volume_files]
-                                
-                                customer_backups.append({
-                                    "name": item,
-                                    "path": item_path,
-                                    "date": date_str,
-                                    "time": time_str,
-                                    "full_date": f"{date_str} {time_str}",
-                                    "timestamp": os.path.getmtime(item_path),
-                                    "size": total_size,
-                                    "size_formatted": f"{total_size / (1024*1024):.2f} MB",
-                                    "file_count": file_count,
-                                    "files": {
-                                        "databases": database_files,
-                                        "volumes": volume_files,
-                                        "others": other_files
-                                    }
-                                })
-                        except Exception as e:
-                            print(f"Error processing backup folder {item}: {e}")
-                            continue
+                # لیست پوشه‌های بک‌اپ (scandir نوع و stat هر مورد را کش می‌کند)
+                with os.scandir(customer_backup_dir) as backup_entries:
+                    for entry in backup_entries:
+                        item = entry.name
+                        item_path = entry.path
+                        
+                        if item.startswith("202") and entry.is_dir():
+                            try:
+                                # پارس کردن تاریخ از نام پوشه
+                                date_parts = item.split('-')
+                                if len(date_parts) >= 3:
+                                    date_str = f"{date_parts[0]}-{date_parts[1]}-{date_parts[2]}"
+                                    time_str = f"{date_parts[3]}:{date_parts[4]}:{date_parts[5]}" if len(date_parts) >= 6 else "00:00:00"
+                                    
+                                    # محاسبه سایز پوشه
+                                    total_size = 0
+                                    file_count = 0
+                                    backup_files = []
+                                    
+                                    for root, dirs, files in os.walk(item_path):
+                                        for file in files:
+                                            if not (file.endswith('.sh') or 'backup_' in file):
+                                                file_path = os.path.join(root, file)
+                                                file_size = os.path.getsize(file_path)
+                                                total_size += file_size
+                                                file_count += 1
+                                                
+                                                # جزئیات فایل
+                                                rel_path = os.path.relpath(file_path, item_path)
+                                                backup_files.append({
+                                                    "name": file,
+                                                    "path": rel_path,
+                                                    "size": file_size,
+                                                    "size_formatted": f"{file_size / 1024:.2f} KB" if file_size < 1024*1024 else f"{file_size / (1024*1024):.2f} MB"
+                                                })
+                                    
+                                    # مرتب کردن فایل‌ها بر اساس نوع
+                                    database_files = [f for f in backup_files if f["name"].endswith('.sql.gz')]
+                                    volume_files = [f for f in backup_files if f["name"].endswith('.tar.gz')]
+                                    other_files = [f for f in backup_files if f not in database_files + volume_files]
+                                    
+                                    customer_backups.append({
+                                        "name": item,
+                                        "path": item_path,
+                                        "date": date_str,
+                                        "time": time_str,
+                                        "full_date": f"{date_str} {time_str}",
+                                        "timestamp": entry.stat().st_mtime,
+                                        "size": total_size,
+                                        "size_formatted": f"{total_size / (1024*1024):.2f} MB",
+                                        "file_count": file_count,
+                                        "files": {
+                                            "databases": database_files,
+                                            "volumes": volume_files,
+                                            "others": other_files
+                                        }
+                                    })
+                            except Exception as e:
+                                print(f"Error processing backup folder {item}: {e}")
+                                continue
                 
                 # مرتب کردن بر اساس تاریخ (جدیدترین اول)
                 customer_backups.sort(key=lambda x: x["timestamp"], reverse=True)
@@ -414,7 +504,7 @@ def api_backup_list():
                 
                 backup_data[customer] = {
                     "name": inventory["all"]["hosts"][customer].get("vars", {}).get("customer_name", customer),
-                    "backup_enabled": inventory["all"]["hosts"][customer].get("vars", {}).get("customer_backup_enabled", inventory.get("all", {}).get("vars", {}).get("customer_backup_enabled", False)),
+                    "backup_enabled": get_customer_vars(customer).get("customer_backup_enabled", False),
                     "backup_path": customer_backup_dir,
                     "backups": customer_backups,
                     "total_backups": total_backups,
@@ -457,16 +547,15 @@ def api_backup_delete():
         
         backup_dir = os.path.join(backup_path, customer, backup_name)
         
-        if not os.path.exists(backup_dir):
+        # حذف پوشه بک‌اپ (بدون بررسی جداگانه وجود پوشه)
+        try:
+            shutil.rmtree(backup_dir)
+        except FileNotFoundError:
             return jsonify({
                 "status": "error",
                 "message": f"بک‌اپ {backup_name} برای مشتری {customer} یافت نشد"
             }), 404
         
-        # حذف پوشه بک‌اپ
-        import shutil
-        shutil.rmtree(backup_dir)
-        
         return jsonify({
             "status": "success",
             "message": f"بک‌اپ {backup_name} با موفقیت حذف شد"
@@ -524,9 +613,8 @@ def api_backup_run_all():
         
         # فقط مشتریانی که بک‌اپ فعال دارند
         active_customers = []
-        for customer, data in customers.items():
-            if data.get("vars", {}).get("customer_backup_enabled", 
-                   inventory.get("all", {}).get("vars", {}).get("customer_backup_enabled", False)):
+        for customer in customers:
+            if get_customer_vars(customer).get("customer_backup_enabled", False):
                 active_customers.append(customer)
         
         # در اینجا می‌توانید دستورات اجرای بک‌اپ را اضافه کنید
@@ -557,33 +645,35 @@ def api_backup_clean():
         
         deleted_count = 0
         
-        import shutil
-        import glob
-        
-        for customer_dir in glob.glob(os.path.join(backup_path, "*")):
-            if os.path.isdir(customer_dir):
-                customer = os.path.basename(customer_dir)
-                keep = inventory.get("all", {}).get("hosts", {}).get(customer, {}).get("vars", {}).get("customer_backup_keep", 
-                       inventory.get("all", {}).get("vars", {}).get("customer_backup_keep", 7))
-                
-                # لیست پوشه‌های بک‌اپ
-                backup_dirs = []
-                for item in os.listdir(customer_dir):
-                    item_path = os.path.join(customer_dir, item)
-                    if os.path.isdir(item_path) and item.startswith("202"):
-                        backup_dirs.append({
-                            "path": item_path,
-                            "name": item,
-                            "mtime": os.path.getmtime(item_path)
-                        })
-                
-                # مرتب کردن بر اساس تاریخ (جدیدترین اول)
-                backup_dirs.sort(key=lambda x: x["mtime"], reverse=True)
-                
-                # حذف بک‌اپ‌های قدیمی
-                for backup in backup_dirs[keep:]:
-                    shutil.rmtree(backup["path"])
-                    deleted_count += 1
+        # معادل glob("*"): پوشه‌های غیرمخفی، بدون stat جداگانه برای هر مورد
+        # مانند glob، پوشه غیرقابل‌خواندن یعنی لیست خالی (نه خطای 500)
+        if os.path.isdir(backup_path) and os.access(backup_path, os.R_OK | os.X_OK):
+            with os.scandir(backup_path) as customer_entries:
+                for customer_entry in customer_entries:
+                    if not customer_entry.name.startswith(".") and customer_entry.is_dir():
+                        customer_dir = customer_entry.path
+                        customer = customer_entry.name
+                        keep = inventory.get("all", {}).get("hosts", {}).get(customer, {}).get("vars", {}).get("customer_backup_keep", 
+                               inventory.get("all", {}).get("vars", {}).get("customer_backup_keep", 7))
+                        
+                        # لیست پوشه‌های بک‌اپ
+                        backup_dirs = []
+                        with os.scandir(customer_dir) as backup_entries:
+                            for entry in backup_entries:
+                                if entry.name.startswith("202") and entry.is_dir():
+                                    backup_dirs.append({
+                                        "path": entry.path,
+                                        "name": entry.name,
+                                        "mtime": entry.stat().st_mtime
+                                    })
+                        
+                        # مرتب کردن بر اساس تاریخ (جدیدترین اول)
+                        backup_dirs.sort(key=lambda x: x["mtime"], reverse=True)
+                        
+                        # حذف بک‌اپ‌های قدیمی
+                        for backup in backup_dirs[keep:]:
+                            shutil.rmtree(backup["path"])
+                            deleted_count += 1
         
         return jsonify({
             "status": "success",
@@ -638,7 +728,7 @@ def api_logs_list():
         
         # پوشه backup logs
         backup_log_path = os.path.join(log_path, "backup")
-        if os.path.exists(backup_log_path) and os.path.isdir(backup_log_path):
+        if os.path.isdir(backup_log_path):
             backup_logs = {}
             
             for log_file in os.listdir(backup_log_path):
@@ -726,14 +816,15 @@ def api_logs_view():
         # خواندن لاگ
         content = read_log_file(log_path, lines, tail)
         
-        # تحلیل خطوط
-        lines_analysis = analyze_log_lines(content.split('\n'))
+        # تحلیل خطوط (یک بار split برای تحلیل و شمارش)
+        content_lines = content.split('\n')
+        lines_analysis = analyze_log_lines(content_lines)
         
         return jsonify({
             "status": "success",
             "path": log_path,
             "filename": os.path.basename(log_path),
-            "total_lines": len(content.split('\n')),
+            "total_lines": len(content_lines),
             "content": content,
             "analysis": lines_analysis
         })
@@ -822,11 +913,27 @@ def get_file_stats(file_path):
     
     modified = datetime.fromtimestamp(stats.st_mtime).strftime('%Y-%m-%d %H:%M:%S')
     
-    # شمارش خطوط
+    # شمارش خطوط روی بایت‌ها (بدون decode کردن کل فایل)
     line_count = 0
     try:
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            line_count = sum(1 for _ in f)
+        with open(file_path, 'rb') as f:
+            # اعلام خواندن ترتیبی به kernel برای readahead بزرگ‌تر (فقط POSIX)
+            if hasattr(os, 'posix_fadvise'):
+                try:
+                    os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                except OSError:
+                    pass
+            # مانند universal newlines حالت متنی: \n، \r\n و \r تنها هر کدام یک پایان خط
+            chunk = b''
+            prev_cr = False
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                line_count += chunk.count(b'\n') + chunk.count(b'\r') - chunk.count(b'\r\n')
+                # \r\n که بین دو chunk شکسته شده فقط یک بار شمرده شود
+                if prev_cr and chunk.startswith(b'\n'):
+                    line_count -= 1
+                prev_cr = chunk.endswith(b'\r')
+            if chunk and not chunk.endswith((b'\n', b'\r')):
+                line_count += 1
     except:
         line_count = 0
     
@@ -41,20 +41,22 @@ def set_crontab(crontab_content, user='root'):
     try:
         # ایجاد فایل موقت
         import tempfile
-        with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
-            f.write(crontab_content)
-            temp_file = f.name
+        fd, temp_file = tempfile.mkstemp()
         
-        # تنظیم crontab
-        if user == 'root':
-            cmd = ['sudo', 'crontab', temp_file]
-        else:
-            cmd = ['crontab', temp_file, '-u', user]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        
-        # حذف فایل موقت
-        os.unlink(temp_file)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(crontab_content)
+            
+            # تنظیم crontab
+            if user == 'root':
+                cmd = ['sudo', 'crontab', temp_file]
+            else:
+                cmd = ['crontab', temp_file, '-u', user]
+            
+            result = subprocess.run(cmd, capture_output=True, text=True)
+        finally:
+            # حذف فایل موقت
+            os.unlink(temp_file)
         
         if result.returncode == 0:
             return True, "Crontab updated successfully"
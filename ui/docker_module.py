@@ -319,10 +319,11 @@ def search_images_by_name(name):
     try:
         all_images = docker_client.images.list(all=True)
         matched = []
+        needle = name.lower()
         
         for image in all_images:
             for tag in (image.tags or []):
-                if name.lower() in tag.lower():
+                if needle in tag.lower():
                     matched.append(image)
                     break
         